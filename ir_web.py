@@ -3,19 +3,30 @@
 ir_web.py — 服务端控制重复（修正版，修复模板花括号导致的 IndexError）
 
 用法:
-  sudo python3 ir_web.py [--host HOST] [--port PORT] [--device /dev/lirc0] [--keyfile key.json] [--repeat-interval 100] [--max-hold 5]
+  sudo python3 ir_web.py [--host HOST] [--port PORT] [--device /dev/lirc0] [--keyfile key.json] [--repeat-interval 100] [--max-hold 5] [--verbose]
 """
 import http.server
 import socketserver
 import json
+import logging
 import os
 import argparse
+import errno
+import fcntl
+import heapq
+import itertools
+import struct
 import subprocess
 import threading
 import time
 import uuid
+from http import HTTPStatus
 from urllib.parse import urlparse
 
+# 按键发送相关日志；每次重复发送只在 DEBUG 级别输出（--verbose），
+# 避免所有按住的按键每个间隔都去争用 stdout
+logger = logging.getLogger(__name__)
+
 parser = argparse.ArgumentParser()
 parser.add_argument("--host", default="0.0.0.0", help="监听地址，默认 0.0.0.0")
 parser.add_argument("--port", type=int, default=8000, help="监听端口，默认 8000")
@@ -27,12 +38,16 @@ parser.add_argument("--template", default="template.html",
                     help="HTML 模板文件（包含占位符 __KEYMAP_JSON__, __REPEAT_INTERVAL__, __MAX_HOLD__, __GEN_UUID__），默认 template.html")
 parser.add_argument("--keylayout", default="key_layout.json",
                     help="按键布局文件，默认 key_layout.json（可选）")
+parser.add_argument("--verbose", action="store_true", help="输出每次重复发送的日志")
 args = parser.parse_args()
+# 启动阶段（如打开 LIRC 设备）就会输出日志，所以在这里而不是 __main__ 中配置
+logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format="%(message)s")
 
 KEYFILE = args.keyfile
 IR_DEVICE = args.device
 REPEAT_INTERVAL_MS = max(1, args.repeat_interval)
 MAX_HOLD_S = max(0.1, args.max_hold)
+DEBOUNCE_S = 0.03  # down 后首次发送前的去抖时间
 
 if not os.path.exists(KEYFILE):
     raise SystemExit(f"找不到 {KEYFILE}，请把 key.json 放在同目录或用 --keyfile 指定路径。")
@@ -53,6 +68,26 @@ with open(TEMPLATE_FILE, "r", encoding="utf-8") as tf:
 if not isinstance(KEYMAP, dict):
     raise SystemExit("key.json 必须是一个对象 (map)。")
 
+# 预先解析 scancode：{按键名: [(整数值, ir-ctl 参数 "nec:<sc>"), ...]}，重复发送时不再解析
+# 按 nec（RC_PROTO_NEC）发送：scancode 只有 16 位（地址 + 命令）。内核 NEC 编码器
+# 会静默截掉更高的位，ir-ctl 的 nec: 则直接拒绝，这里同样在启动时拒绝
+NEC_SCANCODE_MAX = 0xffff
+
+def _parse_scancode(sc):
+    value = int(sc, 0) if isinstance(sc, str) else int(sc)
+    if not 0 <= value <= NEC_SCANCODE_MAX:
+        raise ValueError(f"{sc} 超出 nec scancode 范围 (0-0x{NEC_SCANCODE_MAX:x})")
+    return value
+
+KEY_SCANCODES = {}
+for _name, _scs in KEYMAP.items():
+    if not isinstance(_scs, list):
+        continue
+    try:
+        KEY_SCANCODES[_name] = [(_parse_scancode(sc), f"nec:{sc}") for sc in _scs]
+    except (TypeError, ValueError) as e:
+        raise SystemExit(f"{KEYFILE} 中 {_name} 的 scancode 无效: {e}")
+
 KEY_LAYOUT_FILE = args.keylayout
 if os.path.exists(KEY_LAYOUT_FILE):
     with open(KEY_LAYOUT_FILE, "r", encoding="utf-8") as f:
@@ -63,158 +98,454 @@ if os.path.exists(KEY_LAYOUT_FILE):
 else:
     KEY_LAYOUT = None
 
-# 活动按键跟踪结构
-active_presses = {}
-active_lock = threading.Lock()
+# 除 __GEN_UUID__ 外的占位符在启动后不再变化，只替换一次并预先编码；
+# 使用占位符替换，避免 .format() 对大量 {} 的误解析
+_PAGE_PARTS = HTML_TEMPLATE \
+    .replace("__KEYMAP_JSON__", json.dumps(KEYMAP, ensure_ascii=False)) \
+    .replace("__KEY_LAYOUT_JSON__", json.dumps(KEY_LAYOUT, ensure_ascii=False)) \
+    .replace("__REPEAT_INTERVAL__", str(REPEAT_INTERVAL_MS)) \
+    .replace("__MAX_HOLD__", str(MAX_HOLD_S)) \
+    .encode("utf-8") \
+    .split(b"__GEN_UUID__")
+_KEYJSON_BYTES = json.dumps(KEYMAP, ensure_ascii=False).encode("utf-8")
+
+def _response_head(code, content_type, length):
+    """拼好状态行和固定响应头（不含 Date 和结尾空行），用于内容固定的响应。"""
+    return (f"HTTP/1.1 {code} {HTTPStatus(code).phrase}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            "Cache-Control: no-store\r\n"
+            f"Content-Length: {length}\r\n").encode("latin-1")
+
+# uuid 字符串长度固定，所以首页长度也是固定的
+_PAGE_LENGTH = sum(map(len, _PAGE_PARTS)) + len(str(uuid.UUID(int=0))) * (len(_PAGE_PARTS) - 1)
+_PAGE_HEAD = _response_head(200, "text/html; charset=utf-8", _PAGE_LENGTH)
+_KEYJSON_HEAD = _response_head(200, "application/json; charset=utf-8", len(_KEYJSON_BYTES))
+
+# 活动按键跟踪结构：以按键名为键，多个客户端同时按住同一个键时共用一路重复发送，
+# press["holders"] 记录按住它的 client_id。按键名分成 16 个分片，各自一把锁，
+# 不相关的按键不会互相阻塞
+ACTIVE_SHARDS = 16
+_SHARDS = [({}, threading.Lock()) for _ in range(ACTIVE_SHARDS)]
+
+def _shard(key):
+    """返回 key 所在分片的 (active_presses, lock)。"""
+    return _SHARDS[hash(key) & (ACTIVE_SHARDS - 1)]
+
+# 反向索引 client_id -> 该客户端按住的按键名集合（供以后按客户端断开清理）。
+# 加锁顺序：先分片锁，再 client_holds_lock
+client_holds = {}
+client_holds_lock = threading.Lock()
+
+def _track_hold(client_id, key, held):
+    with client_holds_lock:
+        if held:
+            client_holds.setdefault(client_id, set()).add(key)
+            return
+        keys = client_holds.get(client_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del client_holds[client_id]
+
+# LIRC 直接发送（见 linux/lirc.h）：设为 scancode 模式后 write() 一个 struct lirc_scancode，
+# 由内核编码并发射，省去每次 fork/exec ir-ctl
+LIRC_MODE_SCANCODE = 0x00000008
+LIRC_SET_SEND_MODE = 0x40046911  # _IOW('i', 0x11, __u32)
+RC_PROTO_NEC = 9
+# struct lirc_scancode { __u64 timestamp; __u16 flags; __u16 rc_proto; __u32 keycode; __u64 scancode; }
+LIRC_SCANCODE_FMT = "QHHIQ"
+# 同一按键多个 scancode 之间的间隔（微秒）。取 ir-ctl --gap 的默认值 125 ms，
+# 并显式传给 ir-ctl；LIRC 直接发送时 write() 在帧发射完后才返回，之后再等同样的间隔，
+# 两条路径的帧间时序一致
+SCANCODE_GAP_US = 125000
+
+LIRC_RETRY_S = 5.0  # LIRC 设备不可用时重新尝试打开的间隔
+
+def open_lirc_device(device, level=logging.WARNING):
+    """打开 LIRC 设备并切换到 scancode 发送模式，失败返回 None（回退到 ir-ctl）。"""
+    try:
+        fd = os.open(device, os.O_RDWR)
+    except OSError as e:
+        logger.log(level, "无法打开 %s（%s），将使用 ir-ctl 发送", device, e)
+        return None
+    try:
+        fcntl.ioctl(fd, LIRC_SET_SEND_MODE, struct.pack("I", LIRC_MODE_SCANCODE))
+    except OSError as e:
+        logger.log(level, "%s 不支持 scancode 发送模式（%s），将使用 ir-ctl 发送", device, e)
+        os.close(fd)
+        return None
+    return fd
+
+IR_FD = open_lirc_device(IR_DEVICE)
+_lirc_retry_at = time.monotonic() + LIRC_RETRY_S
+ir_lock = threading.Lock()  # 同一 fd 上的发送需串行
+_lirc_failing = False  # LIRC 写入持续失败时只在第一次输出 WARNING（受 ir_lock 保护）
+
+def _lirc_fd():
+    """返回可用的 LIRC fd（调用方需持有 ir_lock）。
+
+    设备在启动时尚未就绪或中途被移除时，每 LIRC_RETRY_S 秒重试打开一次，
+    恢复后继续复用同一个 fd，而不是一直为每次发送启动 ir-ctl。
+    """
+    global IR_FD, _lirc_retry_at
+    if IR_FD is None and time.monotonic() >= _lirc_retry_at:
+        IR_FD = open_lirc_device(IR_DEVICE, level=logging.DEBUG)
+        if IR_FD is None:
+            _lirc_retry_at = time.monotonic() + LIRC_RETRY_S
+        else:
+            logger.info("已打开 %s，改用 LIRC 直接发送", IR_DEVICE)
+    return IR_FD
+
+def send_scancodes_irctl(args):
+    """一次 ir-ctl 调用依次发送多个 scancode，摊薄 fork/exec 开销。"""
+    cmd = ["ir-ctl", "-d", IR_DEVICE, "--gap", str(SCANCODE_GAP_US)]
+    for arg in args:
+        cmd += ["--scancode", arg]
+    try:
+        subprocess.run(cmd, check=True)
+    except subprocess.CalledProcessError as e:
+        return False, f"Command failed: {' '.join(cmd)} -> {e.returncode}"
+    except FileNotFoundError:
+        return False, "ir-ctl not found (请安装 v4l-utils 或确保 ir-ctl 在 PATH)"
+    except Exception as e:
+        return False, f"执行出错: {e}"
+    return True, "OK"
 
 def send_scancodes_for_key(key_name):
     if key_name not in KEYMAP:
         return False, f"Unknown key: {key_name}"
 
-    scs = KEYMAP[key_name]
-    if not isinstance(scs, list) or not scs:
+    scs = KEY_SCANCODES.get(key_name)
+    if not scs:
         return False, f"Key {key_name} has no scancodes"
 
-    for sc in scs:
-        cmd = ["ir-ctl", "-d", IR_DEVICE, "--scancode", f"nec:{sc}"]
-        try:
-            subprocess.run(cmd, check=True)
-        except subprocess.CalledProcessError as e:
-            return False, f"Command failed: {' '.join(cmd)} -> {e.returncode}"
-        except FileNotFoundError:
-            return False, "ir-ctl not found (请安装 v4l-utils 或确保 ir-ctl 在 PATH)"
-        except Exception as e:
-            return False, f"执行出错: {e}"
-    return True, "OK"
+    global IR_FD, _lirc_failing
+    sent = 0
+    # 整个按键的所有 scancode（包括回退到 ir-ctl 的部分）在一次加锁内发出，
+    # 其他按键的帧不会插在中间
+    with ir_lock:
+        fd = _lirc_fd()
+        if fd is not None:
+            try:
+                for value, _ in scs:
+                    if sent:
+                        time.sleep(SCANCODE_GAP_US / 1e6)
+                    os.write(fd, struct.pack(LIRC_SCANCODE_FMT, 0, 0, RC_PROTO_NEC, 0, value))
+                    sent += 1
+                _lirc_failing = False
+                return True, "OK"
+            except OSError as e:
+                # 持续失败时每次发送都会走到这里，只有第一次用 WARNING
+                level = logging.DEBUG if _lirc_failing else logging.WARNING
+                _lirc_failing = True
+                logger.log(level, "LIRC 发送 %s 失败（%s），回退到 ir-ctl", scs[sent][1], e)
+                if e.errno in (errno.ENODEV, errno.EBADF):
+                    # 设备已消失：关闭后由 _lirc_fd 稍后重试打开
+                    try:
+                        os.close(fd)
+                    except OSError:
+                        pass
+                    IR_FD = None
+        return send_scancodes_irctl([arg for _, arg in scs[sent:]])
 
-def repeat_thread_func(client_id, key_name, stop_event):
-    start = time.monotonic()
-    ok, msg = send_scancodes_for_key(key_name)
-    print(f"[{client_id}] {key_name} initial send -> {ok}, {msg}")
-    interval = REPEAT_INTERVAL_MS / 1000.0
-    while not stop_event.is_set():
-        elapsed = time.monotonic() - start
-        if elapsed >= MAX_HOLD_S:
-            print(f"[{client_id}] {key_name} reached max hold {MAX_HOLD_S}s, auto stopping.")
-            break
-        if stop_event.wait(interval):
-            break
-        ok, msg = send_scancodes_for_key(key_name)
-        print(f"[{client_id}] {key_name} repeat send -> {ok}, {msg}")
-    with active_lock:
-        active_presses.pop((client_id, key_name), None)
-    print(f"[{client_id}] {key_name} thread exit.")
+class RepeatScheduler:
+    """用一个线程为所有按住的按键安排重复发送。
 
-class Handler(http.server.BaseHTTPRequestHandler):
-    def _set_json_headers(self, code=200):
-        self.send_response(code)
-        self.send_header("Content-Type", "application/json; charset=utf-8")
-        self.send_header("Cache-Control", "no-store")
-        self.end_headers()
-
-    def _set_html_headers(self, code=200):
-        self.send_response(code)
-        self.send_header("Content-Type", "text/html; charset=utf-8")
-        self.send_header("Cache-Control", "no-store")
-        self.end_headers()
+    堆中保存 (到期时间, 序号, press)；up 只设置 press 的 stop_event，
+    到期时再丢弃（惰性删除），不需要在堆中查找删除。
+    """
 
-    def do_GET(self):
-        parsed = urlparse(self.path)
-        path = parsed.path
-        if path == "/" or path == "/index.html":
-            # 使用占位符替换，避免 .format() 对大量 {} 的误解析
-            page = HTML_TEMPLATE \
-                .replace("__KEYMAP_JSON__", json.dumps(KEYMAP, ensure_ascii=False)) \
-                .replace("__KEY_LAYOUT_JSON__", json.dumps(KEY_LAYOUT, ensure_ascii=False)) \
-                .replace("__REPEAT_INTERVAL__", str(REPEAT_INTERVAL_MS)) \
-                .replace("__MAX_HOLD__", str(MAX_HOLD_S)) \
-                .replace("__GEN_UUID__", str(uuid.uuid4()))
-            self._set_html_headers(200)
-            self.wfile.write(page.encode("utf-8"))
-            return
-        elif path == "/key.json":
-            self._set_json_headers(200)
-            self.wfile.write(json.dumps(KEYMAP, ensure_ascii=False).encode("utf-8"))
+    def __init__(self, interval):
+        self.interval = interval
+        self._heap = []
+        self._seq = itertools.count()  # 到期时间相同时保持先后顺序，且避免比较 dict
+        self._cond = threading.Condition()
+        self._shutdown = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def shutdown(self):
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify()
+        self._thread.join(timeout=1)
+
+    def add(self, press, due):
+        entry = (due, next(self._seq), press)
+        with self._cond:
+            heapq.heappush(self._heap, entry)
+            # 只有新条目成为堆顶（比当前等待的时刻更早）时才需要唤醒调度线程
+            if self._heap[0] is entry:
+                self._cond.notify()
+
+    def _next_due(self):
+        """阻塞直到堆顶到期，返回 (due, press)；关闭时返回 None。"""
+        with self._cond:
+            while not self._shutdown:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                due = self._heap[0][0]
+                remaining = due - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                due, _, press = heapq.heappop(self._heap)
+                return due, press
+            return None
+
+    def _run(self):
+        while True:
+            item = self._next_due()
+            if item is None:
+                return
+            due, press = item
+            try:
+                self._tick(due, press)
+            except Exception:
+                # 单个按键出错不能让调度线程退出，否则所有按住的按键都停止重复
+                logger.exception("%s repeat failed, releasing.", press["key"])
+                self._release(press, force=True)
+
+    def _tick(self, due, press):
+        """处理一个到期的 press：发送并安排下一次，或结束它。"""
+        key_name = press["key"]
+        if self._release(press):
             return
+        ok, msg = send_scancodes_for_key(key_name)
+        if not ok:
+            # 每个按键只在第一次失败时输出 WARNING，之后的重复失败降为 DEBUG
+            level = logging.DEBUG if press["failed"] else logging.WARNING
+            press["failed"] = True
+        elif not press["sent"]:
+            level = logging.INFO
         else:
-            self.send_response(404)
-            self.end_headers()
-            self.wfile.write(b"Not found")
+            level = logging.DEBUG
+        logger.log(level, "%s %s send -> %s, %s", key_name, "repeat" if press["sent"] else "initial", ok, msg)
+        press["sent"] = True
+        next_due = due + self.interval
+        # 下一次会超过按住上限：本次就是最后一次，立即结束而不是再等一个间隔
+        if next_due >= press["deadline"] and self._release(press, due=next_due):
+            return
+        # 发送耗时超过间隔时不补发积压的重复
+        self.add(press, max(next_due, time.monotonic()))
 
-    def do_POST(self):
-        parsed = urlparse(self.path)
-        path = parsed.path
-        if path == "/action":
-            length = int(self.headers.get("Content-Length", 0))
-            raw = self.rfile.read(length) if length else b""
-            try:
-                data = json.loads(raw.decode("utf-8") if raw else "{}")
-                action = data.get("action")
-                key = data.get("key")
-                client_id = data.get("client_id")
-                if not action or not key or not client_id:
-                    self._set_json_headers(400)
-                    self.wfile.write(json.dumps({"ok": False, "error": "missing action/key/client_id"}).encode("utf-8"))
-                    return
-            except Exception as e:
-                self._set_json_headers(400)
-                self.wfile.write(json.dumps({"ok": False, "error": f"invalid json: {e}"}).encode("utf-8"))
-                return
+    def _release(self, press, force=False, due=None):
+        """press 已无人按住（或 force）时将其移出活动表并返回 True。
 
-            if action == "click":
-                ok, msg = send_scancodes_for_key(key)
-                if ok:
-                    self._set_json_headers(200)
-                    self.wfile.write(json.dumps({"ok": True, "msg": "sent"}).encode("utf-8"))
-                else:
-                    self._set_json_headers(500)
-                    self.wfile.write(json.dumps({"ok": False, "error": msg}).encode("utf-8"))
-                return
+        给出 due 时改为检查按住上限：due 已到 press 的截止时间才释放。
+        两种检查都在分片锁内进行，与 down 复活按键、加入者延长截止时间互斥。
+        """
+        key = press["key"]
+        active_presses, lk = _shard(key)
+        with lk:
+            if due is not None:
+                if due < press["deadline"]:
+                    return False
+                logger.info("%s reached max hold %ss, auto stopping.", key, MAX_HOLD_S)
+            elif not force and not press["stop_event"].is_set():
+                return False
+            press["stop_event"].set()
+            for client_id in press["holders"]:
+                _track_hold(client_id, key, False)
+            press["holders"].clear()
+            if active_presses.get(key) is press:
+                del active_presses[key]
+        logger.info("%s repeat stopped.", key)
+        return True
 
-            elif action == "down":
-                with active_lock:
-                    k = (client_id, key)
-                    if k in active_presses:
-                        self._set_json_headers(200)
-                        self.wfile.write(json.dumps({"ok": True, "msg": "already down"}).encode("utf-8"))
-                        return
-                    stop_event = threading.Event()
-                    th = threading.Thread(target=repeat_thread_func, args=(client_id, key, stop_event), daemon=True)
-                    active_presses[k] = {"thread": th, "stop_event": stop_event, "start_time": time.monotonic()}
-                    th.start()
-                self._set_json_headers(200)
-                self.wfile.write(json.dumps({"ok": True, "msg": "started"}).encode("utf-8"))
-                return
+scheduler = RepeatScheduler(REPEAT_INTERVAL_MS / 1000.0)
 
-            elif action == "up":
-                with active_lock:
-                    k = (client_id, key)
-                    info = active_presses.get(k)
-                    if not info:
-                        self._set_json_headers(200)
-                        self.wfile.write(json.dumps({"ok": True, "msg": "not active"}).encode("utf-8"))
-                        return
-                    info["stop_event"].set()
-                self._set_json_headers(200)
-                self.wfile.write(json.dumps({"ok": True, "msg": "stopping"}).encode("utf-8"))
+def _static_json(code, obj):
+    """内容固定的 JSON 响应：(状态码, 预拼好的响应头, 响应体)。"""
+    body = json.dumps(obj).encode("utf-8")
+    return code, _response_head(code, "application/json; charset=utf-8", len(body)), body
+
+# 固定内容的 JSON 响应，启动时连同响应头一起拼好
+_RESP_SENT = _static_json(200, {"ok": True, "msg": "sent"})
+_RESP_STARTED = _static_json(200, {"ok": True, "msg": "started"})
+_RESP_ALREADY_DOWN = _static_json(200, {"ok": True, "msg": "already down"})
+_RESP_STOPPING = _static_json(200, {"ok": True, "msg": "stopping"})
+_RESP_NOT_ACTIVE = _static_json(200, {"ok": True, "msg": "not active"})
+_RESP_MISSING_FIELDS = _static_json(400, {"ok": False, "error": "missing action/key/client_id"})
+_RESP_UNKNOWN_ACTION = _static_json(400, {"ok": False, "error": "unknown action"})
+_RESP_NOT_OBJECT = _static_json(400, {"ok": False, "error": "body must be a JSON object"})
+_RESP_FIELDS_NOT_STR = _static_json(400, {"ok": False, "error": "action/key/client_id must be strings"})
+_RESP_LENGTH_REQUIRED = _static_json(411, {"ok": False, "error": "Content-Length required"})
+_RESP_BAD_LENGTH = _static_json(400, {"ok": False, "error": "invalid Content-Length"})
+_RESP_NOT_FOUND = (404, _response_head(404, "text/plain; charset=utf-8", len(b"Not found")), b"Not found")
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # HTTP/1.1 持久连接：网页的 down/up 请求复用同一个 TCP 连接，
+    # 前提是每个响应都带 Content-Length
+    protocol_version = "HTTP/1.1"
+    # 小 JSON 响应不要被 Nagle 算法延迟
+    disable_nagle_algorithm = True
+    # 空闲的持久连接超时后关闭，避免长期占用线程
+    timeout = 60
+
+    def _send_json(self, code, body):
+        """内容不固定的 JSON 响应，同样拼成一段字节一次写出。"""
+        self._send_cached(code, _response_head(code, "application/json; charset=utf-8", len(body)), body)
+
+    def _send_cached(self, code, head, body):
+        """head 来自 _response_head，只补上 Date，与 body 一起一次写出。"""
+        self.log_request(code, len(body))
+        self.wfile.write(b"".join((head, b"Date: ", self.date_time_string().encode("ascii"), b"\r\n\r\n", body)))
+
+    def _send_static(self, resp):
+        self._send_cached(*resp)
+
+    def _send_not_found(self):
+        self._send_static(_RESP_NOT_FOUND)
+
+    def _serve_index(self):
+        page = str(uuid.uuid4()).encode("ascii").join(_PAGE_PARTS)
+        self._send_cached(200, _PAGE_HEAD, page)
+
+    def _serve_keyjson(self):
+        self._send_cached(200, _KEYJSON_HEAD, _KEYJSON_BYTES)
+
+    def _handle_action(self):
+        length = self.headers.get("Content-Length")
+        if length is None:
+            # 只支持带 Content-Length 的请求体；分块等未读取的请求体会被当成下一个请求，
+            # 所以回复后关闭连接
+            if "Transfer-Encoding" in self.headers:
+                self.close_connection = True
+                self._send_static(_RESP_LENGTH_REQUIRED)
                 return
-            else:
-                self._set_json_headers(400)
-                self.wfile.write(json.dumps({"ok": False, "error": "unknown action"}).encode("utf-8"))
+            length = 0
+        else:
+            try:
+                length = int(length)
+                if length < 0:
+                    raise ValueError
+            except ValueError:
+                self.close_connection = True
+                self._send_static(_RESP_BAD_LENGTH)
                 return
+        raw = self.rfile.read(length) if length else b""
+        try:
+            # json.loads 直接接受 bytes，省去一次 decode
+            data = json.loads(raw) if raw else {}
+        except (ValueError, RecursionError) as e:
+            self._send_json(400, json.dumps({"ok": False, "error": f"invalid json: {e}"}).encode("utf-8"))
+            return
+        # 请求体固定为 {"action": str, "key": str, "client_id": str}，一次校验完
+        if not isinstance(data, dict):
+            self._send_static(_RESP_NOT_OBJECT)
+            return
+        action = data.get("action")
+        key = data.get("key")
+        client_id = data.get("client_id")
+        if not action or not key or not client_id:
+            self._send_static(_RESP_MISSING_FIELDS)
+            return
+        if not (type(action) is str and type(key) is str and type(client_id) is str):
+            self._send_static(_RESP_FIELDS_NOT_STR)
+            return
+
+        handler = self.ACTIONS.get(action)
+        if handler is None:
+            self._send_static(_RESP_UNKNOWN_ACTION)
+            return
+        handler(self, key, client_id)
+
+    def _do_click(self, key, client_id):
+        ok, msg = send_scancodes_for_key(key)
+        if ok:
+            self._send_static(_RESP_SENT)
         else:
-            self.send_response(404)
-            self.end_headers()
-            self.wfile.write(b"Not found")
+            self._send_json(500, json.dumps({"ok": False, "error": msg}).encode("utf-8"))
+
+    def _do_down(self, key, client_id):
+        active_presses, lk = _shard(key)
+        # 锁内只做判断和登记；加入调度器和写响应都在锁外进行
+        press = None
+        with lk:
+            info = active_presses.get(key)
+            if info is not None and client_id in info["holders"]:
+                already_down = True
+            else:
+                already_down = False
+                if info is None or (info["stop_event"].is_set() and info["sent"]):
+                    # 已 up 但尚未被调度线程清理的旧记录直接替换
+                    start = time.monotonic()
+                    press = {"key": key, "holders": set(), "stop_event": threading.Event(),
+                             "start_time": start, "deadline": start + MAX_HOLD_S,
+                             "sent": False, "failed": False}
+                    info = active_presses[key] = press
+                else:
+                    if info["stop_event"].is_set():
+                        # 去抖：up 后在首次发送前又收到 down（down/up 抖动），沿用原来的按键
+                        info["stop_event"].clear()
+                        already_down = True
+                    # 加入者同样享有完整的 MAX_HOLD_S，不沿用第一个按住者的截止时间
+                    info["deadline"] = max(info["deadline"], time.monotonic() + MAX_HOLD_S)
+                # 其他客户端已按住同一个键时只加入 holders，不另起一路发送
+                info["holders"].add(client_id)
+                _track_hold(client_id, key, True)
+        if already_down:
+            self._send_static(_RESP_ALREADY_DOWN)
+            return
+        if press is not None:
+            # 加入堆之前到达的 up 只会设置 stop_event，调度线程首次发送前会检查
+            # 首次发送推迟 DEBOUNCE_S，期间收到 up 则一次也不发送
+            scheduler.add(press, press["start_time"] + DEBOUNCE_S)
+        self._send_static(_RESP_STARTED)
+
+    def _do_up(self, key, client_id):
+        active_presses, lk = _shard(key)
+        with lk:
+            info = active_presses.get(key)
+            active = info is not None and client_id in info["holders"]
+            if active:
+                info["holders"].discard(client_id)
+                _track_hold(client_id, key, False)
+                # 最后一个按住的客户端松开才停止发送
+                if not info["holders"]:
+                    info["stop_event"].set()
+        self._send_static(_RESP_STOPPING if active else _RESP_NOT_ACTIVE)
+
+    # 路由/动作表：一次 dict 查找代替逐个字符串比较，新增路由只需加一项
+    GET_ROUTES = {"/": _serve_index, "/index.html": _serve_index, "/key.json": _serve_keyjson}
+    POST_ROUTES = {"/action": _handle_action}
+    ACTIONS = {"click": _do_click, "down": _do_down, "up": _do_up}
+
+    def do_GET(self):
+        route = self.GET_ROUTES.get(urlparse(self.path).path)
+        if route is None:
+            self._send_not_found()
+            return
+        route(self)
+
+    def do_POST(self):
+        route = self.POST_ROUTES.get(urlparse(self.path).path)
+        if route is None:
+            # 未读取请求体，不能继续复用该连接
+            self.close_connection = True
+            self._send_not_found()
+            return
+        route(self)
 
     def log_message(self, format, *args):
         print("%s - - [%s] %s" % (self.client_address[0], self.log_date_time_string(), format%args))
 
 class ThreadedHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
     daemon_threads = True
+    request_queue_size = 128
+
+# 请求线程和按键重复线程都很浅，不需要默认的 8 MB 栈；
+# 缩小后大量并发连接/按住的按键只占少量地址空间（对 32 位树莓派系统尤其重要）
+THREAD_STACK_SIZE = 1024 * 1024
 
 
 if __name__ == "__main__":
+    threading.stack_size(THREAD_STACK_SIZE)
+    scheduler.start()
     server = ThreadedHTTPServer((args.host, args.port), Handler)
     print(f"Starting server on http://{args.host}:{args.port}/")
     print(f"Using key file: {KEYFILE}")
@@ -225,8 +556,10 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         print("Shutting down...")
     finally:
-        with active_lock:
-            for k, info in list(active_presses.items()):
-                info["stop_event"].set()
+        for active_presses, lk in _SHARDS:
+            with lk:
+                for info in active_presses.values():
+                    info["stop_event"].set()
+        scheduler.shutdown()
         server.shutdown()
         server.server_close()